@@ -1,88 +1,264 @@
 """
 LADA – Local Agent Driven Assistant  v0.2
 """
-import os, json, pathlib, subprocess, webbrowser, datetime, shlex, tempfile
-import threading
-from flask import Flask, render_template, request, jsonify
+from __future__ import annotations
+
+import os
+# Socket.IO server mode. Set LADA_ASYNC_MODE=eventlet (pip install eventlet)
+# for green-thread I/O -- the monkey-patch has to run before socket/threading
+# are imported below. The default is pinned to "threading": left to itself
+# Flask-SocketIO picks eventlet whenever it is installed, and unpatched, one
+# blocking LLM call would then stall every other client.
+ASYNC_MODE = os.environ.get("LADA_ASYNC_MODE") or "threading"
+if ASYNC_MODE == "eventlet":
+    import eventlet
+    eventlet.monkey_patch()
+
+import pathlib, subprocess, webbrowser, datetime, shlex, tempfile, errno, importlib.util, signal
+import threading, mmap, collections, functools, logging, atexit, queue, hashlib, itertools, time
+import orjson
+import msgspec
+from flask import Flask, Response, render_template, request
+from flask.json.provider import JSONProvider
 from flask_socketio import SocketIO
 import concurrent.futures
-from openai import OpenAI  # new 1.x import
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from openai.types.chat.chat_completion import Choice
+# openai itself (httpx, pydantic, anyio) is imported on first use, so the
+# server and /api/command come up without paying for it
+
+log = logging.getLogger("lada.orch")
+
+# ---------- JSON shim (orjson) ---------- #
+def _loads(s):
+    """Parse a JSON string/bytes; empty input (e.g. missing tool args) -> {}."""
+    # "{}" is what argument-less tool calls send; skip the parser for it
+    return orjson.loads(s) if s and s != "{}" else {}
+
+def _dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+class ORJSONProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (request.json, jsonify, ...)."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
-socketio = SocketIO(app, cors_allowed_origins="*")
+app.json = ORJSONProvider(app)
+# Socket.IO packets go through the same orjson provider
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, json=app.json)
 
-HISTORY_FILE = "../history.json"
+HISTORY_FILE = "../history.jsonl"  # append-only, one JSON record per line
 USE_SESSION_HISTORY = False  
+# The file is the full record (/api/history serves it); in memory only the
+# tails that prompts are built from are kept.
+HISTORY_WINDOW = 40  # most recent records sent to the LLM as context
+HISTORY_TAIL: collections.deque[dict] = collections.deque(maxlen=HISTORY_WINDOW)
 if USE_SESSION_HISTORY:
     try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            HISTORY: list[dict] = json.load(f)
-    except FileNotFoundError:
-        HISTORY = []
+        with open(HISTORY_FILE, "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            HISTORY_TAIL.extend(_loads(line) for line in iter(mm.readline, b"") if line.strip())
+    except (FileNotFoundError, ValueError):  # ValueError: empty file can't be mmapped
+        pass
 else:
     # Erase history file on start if not using session history
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        f.write("[]")
-    HISTORY = []
-_hist_lock = threading.Lock()  # lock for HISTORY access
+    open(HISTORY_FILE, "wb").close()
+ROUTER_WINDOW = 6    # the router only needs the last few turns
+ROUTER_TAIL: collections.deque[dict] = collections.deque(HISTORY_TAIL, maxlen=ROUTER_WINDOW)
+_hist_lock = threading.Lock()  # lock for the tails and the log file
+
+def add_history_many(records: list[tuple[str, str]]) -> None:
+    """Append several (role, content) records under one lock and one write.
+
+    Only the new records are written to disk, so persisting a turn costs
+    O(new messages) instead of rewriting the whole history.
+    """
+    if not records:
+        return
+    buf = bytearray()
+    with _hist_lock:
+        for role, content in records:
+            entry = {"role": role, "content": content}
+            HISTORY_TAIL.append(entry)
+            ROUTER_TAIL.append(entry)
+            buf += orjson.dumps(entry) + b"\n"
+        HISTORY_Q.put(bytes(buf))  # under the lock so the file keeps the tails' order
+
+# Disk writes happen on a background thread: request threads only enqueue
+# serialized lines, and whatever piled up meanwhile goes out in one write().
+HISTORY_Q: queue.Queue[bytes] = queue.Queue()
+
+def _history_writer() -> None:
+    while True:
+        batch = [HISTORY_Q.get()]
+        try:
+            while True:
+                batch.append(HISTORY_Q.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            with open(HISTORY_FILE, "ab") as f:
+                f.write(b"".join(batch))
+        except OSError:
+            log.exception("could not append %d history batch(es)", len(batch))
+        finally:
+            for _ in batch:
+                HISTORY_Q.task_done()
+
+threading.Thread(target=_history_writer, name="history-writer", daemon=True).start()
+atexit.register(HISTORY_Q.join)  # don't lose queued records on shutdown
+
 def add_history(role: str, content: str) -> None:
     """Thread-safe append without system/LLM scaffolding."""
+    add_history_many([(role, content)])
+
+def history_window(system: dict | None = None, tail: collections.deque = HISTORY_TAIL) -> list[dict]:
+    """Snapshot of the last records (HISTORY_TAIL by default) for prompts.
+
+    With *system*, that message is placed first in the same list, so callers
+    don't pay for a second copy concatenating it on.
+    """
     with _hist_lock:
-        HISTORY.append({"role": role, "content": content})
+        if system is None:
+            return list(tail)
+        return [system, *tail]
 # ---------- conversation-logging helpers ---------- #
-def log_tool_call(name: str, args: dict) -> None:
+def log_tool_calls(calls) -> None:
     """
-    Append a readable trace of a tool/command invocation to HISTORY
-    so the frontend can display it in-line with the chat.
+    Append a readable trace of each (name, args) tool/command invocation to
+    the history, under one lock, so the frontend can display it in-line
+    with the chat.
     """
-    # HISTORY.append({
-    #     "role": "assistant",
-    #     "content": f"[tool_call] {name} {json.dumps(args, ensure_ascii=False)}"
-    # })
-    add_history("assistant", f"[tool_call] {name} {json.dumps(args, ensure_ascii=False)}")
-
-def flush_history_to_disk() -> None:
-    """Persist the in-memory HISTORY to history.json."""
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(HISTORY, f, ensure_ascii=False, indent=2)
+    add_history_many([("assistant", tool_call_trace(name, args)) for name, args in calls])
+
+def tool_call_trace(name: str, args: dict) -> str:
+    """The "[tool_call] ..." line that log_tool_calls records."""
+    return f"[tool_call] {name} {_dumps(args)}"
+
 # ---------- helpers ---------- #
+# Read timeout for streamed calls, i.e. the longest gap between chunks; the
+# SDK default of 600 s lets one stalled connection pin an agent thread for
+# ten minutes.
+LLM_TIMEOUT = 60.0
+# Non-streamed calls (router, orchestrator) get no bytes until the model has
+# finished, so their read timeout has to cover the whole generation, e.g. a
+# long plan from a local Ollama model.
+LLM_GENERATION_TIMEOUT = 300.0
+
 def get_client(provider: str, token: str | None = None):
+    """One client (and HTTP connection pool) per endpoint/token pair.
+
+    OpenAI clients are thread-safe and never mutated per request, so the
+    router, orchestrator and agent threads can all share them. The key is
+    normalized first: provider-name casing doesn't matter, and Ollama
+    ignores the token, so those variants all land on the same pool.
+    """
     if provider.lower() == "ollama":
-        return OpenAI(base_url="http://localhost:11434/v1", api_key="ollama")
-    if token:
-        return OpenAI(api_key=token)
-    return OpenAI()
+        return _client("ollama", None)
+    return _client("openai", token or None)
+
+LLM_CONNECT_TIMEOUT = 5.0  # an unreachable endpoint should fail fast
+
+@functools.lru_cache(maxsize=8)
+def _client(endpoint: str, token: str | None):
+    from openai import OpenAI, DefaultHttpxClient, Timeout
+    timeout = Timeout(LLM_GENERATION_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    if endpoint == "ollama":
+        return OpenAI(base_url="http://localhost:11434/v1", api_key="ollama",
+                      max_retries=2, timeout=timeout)
+    # HTTP/2 multiplexes concurrent agent requests over one TLS connection;
+    # httpx needs the optional h2 package for it (pip install httpx[http2])
+    http_client = DefaultHttpxClient(http2=True) if importlib.util.find_spec("h2") else None
+    return OpenAI(api_key=token or None, timeout=timeout, http_client=http_client)
 
 ROOT_DIR = pathlib.Path.cwd().resolve()
+ROOT_STR = str(ROOT_DIR)
+_ROOT_PREFIX = os.path.join(ROOT_STR, "")  # with trailing separator
 
-def within_root(path: pathlib.Path) -> bool:
+def within_root(path) -> bool:
     """Return True if *path* is within the starting directory."""
-    try:
-        path.resolve(strict=False).relative_to(ROOT_DIR)
-        return True
-    except ValueError:
-        return False
+    # realpath keeps the symlink check of Path.resolve(); the prefix test
+    # replaces relative_to() and its ValueError round-trip
+    p = os.path.realpath(os.path.expanduser(os.fspath(path)))
+    return p == ROOT_STR or p.startswith(_ROOT_PREFIX)
+
+_PATH_START = frozenset("./~")
 
 def token_is_path(token: str) -> bool:
-    if token.startswith("-"):
-        return False
-    return token.startswith(('.', '/', '~')) or '/' in token
+    """Not a flag, and either starts like a path or contains a separator."""
+    return bool(token) and token[0] != "-" and (token[0] in _PATH_START or "/" in token)
+
+# agents re-issue the same few commands (ls, cat, git status) all session
+@functools.lru_cache(maxsize=2048)
+def split_cmd(command: str) -> tuple[str, ...]:
+    return tuple(shlex.split(command))
+
+CMD_TIMEOUT = 30
+CMD_MAX_OUTPUT = 1 << 20  # chars kept from one command; the rest is cut off
+
+def _kill_group(proc: subprocess.Popen) -> None:
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
 
 def run_cmd(command: str) -> str:
-    tokens = shlex.split(command)
-    for t in tokens:
-        if token_is_path(t):
-            p = pathlib.Path(t).expanduser()
-            if not within_root(p):
-                return "Blocked: path outside working directory."
+    tokens = split_cmd(command)
+    bad = next((t for t in tokens if token_is_path(t) and not within_root(t)), None)
+    if bad is not None:
+        return "Blocked: path outside working directory."
     try:
-        res = subprocess.run(tokens,
-                             capture_output=True,
-                             text=True,
-                             timeout=30)
-        return (res.stdout or "") + (res.stderr or "")
+        # own session so a timed-out command can't leave a stray process
+        # group attached to the server
+        # stderr shares stdout's pipe: one reader, output already interleaved
+        proc = subprocess.Popen(tokens,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                encoding="utf-8", errors="replace",
+                                start_new_session=True,
+                                close_fds=True)
     except Exception as exc:
         return f"Command error: {exc}"
+    # Read at most CMD_MAX_OUTPUT instead of buffering everything (`find /`,
+    # `cat big.log`); the timer kills the whole group if it runs too long.
+    killer = threading.Timer(CMD_TIMEOUT, _kill_group, (proc,))
+    killer.start()
+    try:
+        with proc.stdout:
+            out = proc.stdout.read(CMD_MAX_OUTPUT)
+            if len(out) == CMD_MAX_OUTPUT:
+                _kill_group(proc)
+                out += f"\n[output truncated at {CMD_MAX_OUTPUT} chars]\n"
+        proc.wait()
+    except Exception as exc:
+        _kill_group(proc)
+        proc.wait()
+        return f"Command error: {exc}"
+    finally:
+        timed_out = not killer.is_alive()
+        killer.cancel()
+    if timed_out:
+        return f"Command error: {subprocess.TimeoutExpired(list(tokens), CMD_TIMEOUT)}"
+    return out
+
+# Start the orchestrator's first planning call in parallel with the router.
+# Saves a round-trip on hand_off at the cost of a wasted call on 'answer'.
+SPECULATIVE_PLANNING = True
+
+# shared pool for coder agents; reused across rounds and requests
+# (sized for several concurrent chats; each request's `workers` setting is
+# enforced by dispatch() capping agent ids, not by the pool size)
+AGENT_WORKERS = max(32, (os.cpu_count() or 1) * 4)
+AGENT_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=AGENT_WORKERS, thread_name_prefix="agent")
+atexit.register(AGENT_POOL.shutdown, wait=False, cancel_futures=True)
 
 # ---------- OpenAI tools ---------- #
 TOOLS = [
@@ -161,6 +337,11 @@ DECISION_SCHEMA = {
     "required": ["action"]
 }
 
+class Decision(msgspec.Struct):
+    """Arguments of the router's `route` call."""
+    action: str = "hand_off"
+    answer: str = ""
+
 DECISION_TOOL = {
     "type": "function",
     "function": {
@@ -170,37 +351,376 @@ DECISION_TOOL = {
     },
 }
 
+# router request pieces, built once
+ROUTER_SYS = (
+    "You are a routing assistant. Decide **only** whether the last user "
+    "message should be handled directly by the lightweight coder model "
+    "(`answer`) or forwarded to the orchestrator (`hand_off`). "
+    "Return the decision by calling the `route` function and nothing else."
+)
+ROUTER_TOOLS = [DECISION_TOOL]
+ROUTER_TOOL_CHOICE = {"type": "function", "function": {"name": "route"}}
+
+# fixed system prompts; keeping them byte-identical across requests lets a
+# local server reuse the cached prompt prefix
+CODER_SYS = {"role": "system", "content": "You are a helpful coding assistant."}
+AGENT_SYS_TEMPLATE = "You are coder agent %d. Complete ONLY the following tasks in order:\n%s"
+
+# ---------- orchestrator planning ---------- #
+PLANNER_SYS_TEMPLATE = (
+    # "You are an orchestrator. Coder agents are independent and share no "
+    # "memory. Each agent only sees its own task list. You have up to %d "
+    # "workers available and must never exceed this number. "
+    # "When assigning "
+    # "tasks do not rely on one agent continuing work of another unless you "
+    # "explicitly provide the previous results. Respond ONLY with JSON like: "
+    # "{\"agents\":N,\"tasks\":[{\"agent\":1,\"desc\":\"task\"}]}"
+    " You are a code super agent and have the ability to orchestrate multiple smaller agents. "
+    " Your overall job is to guide the process and assign super specific tasks to smaller agents. "
+    " You can do this by assigning tasks to individual agents or you can execute commands on your own (the smaller agents can also execute the same commands like writing, reading and chaning files). "
+    " Before creating smaller agents, create a detailed plan for everything that needs to be done. "
+    " Right now you can have up to %d workers for 1 iteration. "
+    " When you spawn a new agent it has no memory of previous tasks so you should give it a detailed prompt and list what it needs to do. "
+    " Your agents work in parallel and can execute tasks independently but won't be able to work on the same file. "
+    " You also have the ability to execute more iterations after one is compelte - if a process requires more steps than your available workers or needs something to be done in sequence like writing a file then reading it, you can do that by creating more agents after you got feedback from the previous ones.\n\n "
+    "When assigning tasks do not rely on one agent continuing work of another unless you "
+    "explicitly provide the previous results. Respond ONLY with JSON like: "
+    "{\"agents\":N,\"tasks\":[{\"agent\":1,\"desc\":\"task\"}]}"
+    " When one a iteration is over and you have the results from all agents and think that the process is complete, report to the user with summary of what has been done. "
+    " This is the history of the conversation so far: \n"
+)
+
+@functools.lru_cache(maxsize=8)
+def planner_sys_for(workers: int) -> str:
+    return PLANNER_SYS_TEMPLATE % workers
+
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "agents": {"type": "integer"},
+        "tasks": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "agent": {"type": "integer"},
+                    "desc": {"type": "string"},
+                },
+                "required": ["agent", "desc"],
+            },
+        },
+    },
+    "required": ["agents", "tasks"],
+}
+
+
+PLAN_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "make_plan",
+        "description": "Return a plan for the requested tasks.",
+        "parameters": PLAN_SCHEMA,
+    },
+}
+
+class Task(msgspec.Struct):
+    agent: int = 1
+    desc: str = ""
+
+class Plan(msgspec.Struct):
+    """A make_plan payload; both keys are required, as in PLAN_SCHEMA."""
+    agents: int
+    tasks: list[Task]
+
+def parse_plan(raw) -> Plan | None:
+    """Validate a plan from make_plan args (dict) or a JSON text reply.
+
+    Returns None for anything that isn't a plan, e.g. the orchestrator's
+    final prose summary. Lenient about numbers sent as strings ("2").
+    """
+    try:
+        if isinstance(raw, dict):
+            return msgspec.convert(raw, Plan, strict=False)
+        if isinstance(raw, (str, bytes)):
+            return msgspec.json.decode(raw, type=Plan, strict=False)
+        return None  # make_plan args of null, [] or a bare number
+    except msgspec.DecodeError:  # also covers ValidationError
+        return None
+
+# tool list offered to the orchestrator, built once
+ORCH_TOOLS = TOOLS + [PLAN_TOOL]
+
+def emit_plan(plan: Plan | None, raw: str, round_no: int) -> None:
+    """Send a plan to the browser as an object, not a JSON string.
+
+    A string would be escaped a second time inside the event payload; raw
+    text is only sent when it didn't parse, for display as-is.
+    """
+    payload = msgspec.to_builtins(plan) if plan is not None else raw
+    socketio.emit('plan', {'plan': payload, 'round': round_no})
+
+
+# models keep naming the same handful of files; Path objects are immutable,
+# so one expanded instance per name can be shared between calls
+@functools.lru_cache(maxsize=1024)
+def tool_path(filename: str) -> pathlib.Path:
+    return pathlib.Path(filename).expanduser()
+
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0) | getattr(os, "O_CLOEXEC", 0)
 
 def write_file(filename, content):       # ↙ simple helpers
-    path = pathlib.Path(filename).expanduser()
-    path.parent.mkdir(parents=True, exist_ok=True)
-    path.write_text(content)
-    return f"Wrote {path} ({len(content)} bytes)."
+    path = tool_path(filename)
+    data = content.encode()
+    # open first and only create parents when that fails: the common case
+    # (directory exists) costs one open instead of stat+mkdir+open
+    try:
+        fd = os.open(path, _WRITE_FLAGS, 0o644)
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(path, _WRITE_FLAGS, 0o644)
+    except OSError as exc:
+        if exc.errno == errno.ELOOP:
+            return f"Blocked: {path} is a symlink."
+        raise
+    try:
+        view = memoryview(data)
+        while view:  # one write() for any sane size; loop covers short writes
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    _forget_read(path)
+    return f"Wrote {path} ({len(data)} bytes)."
+
+# Decoded contents of recently read files. Agents re-read the same sources
+# every round; an entry is reused only while the file's stat signature is
+# unchanged, and the tools that write files drop their entries eagerly.
+READ_CACHE_ENTRIES = 64
+# A file changed this recently may change again within the same timestamp
+# tick without its signature moving (a same-size rewrite through run_cmd),
+# so it isn't cached until it has been quiet this long ("racy git").
+READ_CACHE_RACY_NS = 1_000_000_000
+READ_CACHE_CHARS = 16 << 20
+_READ_CACHE: collections.OrderedDict[pathlib.Path, tuple[tuple, str]] = collections.OrderedDict()
+_read_cache_chars = 0
+_READ_LOCK = threading.Lock()
+
+def _forget_read(*paths: pathlib.Path) -> None:
+    global _read_cache_chars
+    with _READ_LOCK:
+        for p in paths:
+            hit = _READ_CACHE.pop(p, None)
+            if hit is not None:
+                _read_cache_chars -= len(hit[1])
 
 def read_file(filename):
-    p = pathlib.Path(filename).expanduser()
-    return p.read_text() if p.exists() else f"{p} not found."
+    global _read_cache_chars
+    p = tool_path(filename)
+    try:
+        st = os.stat(p)
+    except (FileNotFoundError, NotADirectoryError):
+        return f"{p} not found."
+    sig = (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+    with _READ_LOCK:
+        hit = _READ_CACHE.get(p)
+        if hit is not None and hit[0] == sig:
+            _READ_CACHE.move_to_end(p)
+            return hit[1]
+    text = p.read_text()
+    _forget_read(p)
+    racy = time.time_ns() - max(st.st_mtime_ns, st.st_ctime_ns) < READ_CACHE_RACY_NS
+    if not racy and len(text) <= READ_CACHE_CHARS // 4:
+        with _READ_LOCK:
+            _READ_CACHE[p] = (sig, text)
+            _read_cache_chars += len(text)
+            while len(_READ_CACHE) > READ_CACHE_ENTRIES or _read_cache_chars > READ_CACHE_CHARS:
+                _read_cache_chars -= len(_READ_CACHE.popitem(last=False)[1][1])
+    return text
+
+# git output is only read on failure; the C locale spares it the gettext
+# catalogue lookups on every call
+GIT_ENV = {**os.environ, "LC_ALL": "C"}
 
 def change_file(filename: str, patch: str):
     """Apply a git patch to *filename* and return result."""
-    path = pathlib.Path(filename).expanduser()
+    path = tool_path(filename)
     if not within_root(path):
         return "Blocked: path outside working directory."
     try:
         res = subprocess.run(
             ["git", "apply", "-"],
-            input=patch,
-            text=True,
+            input=patch.encode(),
             capture_output=True,
             cwd=ROOT_DIR,
+            env=GIT_ENV,
         )
         if res.returncode != 0:
             content = path.read_text() if path.exists() else ""
-            return f"Patch failed:\n{res.stderr}\nCurrent file:\n{content}"
+            return f"Patch failed:\n{res.stderr.decode(errors='replace')}\nCurrent file:\n{content}"
+        _forget_read(path)
         return f"Patch applied to {path}."
     except Exception as exc:
         return f"Error applying patch: {exc}"
 
+def change_files(calls: list[dict]) -> list[str] | None:
+    """Apply several ``change_file`` patches with a single ``git apply``.
+
+    git applies a multi-file diff atomically, so on any failure nothing has
+    changed and None is returned; the caller then applies the patches one by
+    one to get per-file error messages.
+    """
+    if not all(isinstance(c.get("filename"), str) and isinstance(c.get("patch"), str) for c in calls):
+        return None
+    paths = [tool_path(c["filename"]) for c in calls]
+    if not all(within_root(p) for p in paths):
+        return None
+    patch = "".join(c["patch"] if c["patch"].endswith("\n") else c["patch"] + "\n" for c in calls)
+    try:
+        res = subprocess.run(["git", "apply", "-"], input=patch.encode(),
+                             capture_output=True, cwd=ROOT_DIR, env=GIT_ENV)
+    except Exception:
+        return None
+    if res.returncode != 0:
+        return None
+    _forget_read(*paths)
+    return [f"Patch applied to {p}." for p in paths]
+
+def dump_tool_call(tc) -> dict:
+    """Plain-dict form of an SDK tool call for echoing back in messages.
+
+    Built field by field: the API only needs these four, and a literal is
+    much cheaper than pydantic's model_dump() walk.
+    """
+    return {"id": tc.id, "type": "function",
+            "function": {"name": tc.function.name, "arguments": tc.function.arguments}}
+
+# Completed choices keyed by a hash of (endpoint, request). A retried prompt
+# or a replayed agent transcript identical to a recent one skips the model
+# call; only the reply is reused, tool calls in it still execute again.
+RESPONSE_CACHE_SIZE = 512
+_RESPONSE_CACHE: collections.OrderedDict[bytes, Choice] = collections.OrderedDict()
+_RESPONSE_CACHE_LOCK = threading.Lock()
+
+def _response_key(client, kwargs: dict) -> bytes:
+    # the token is part of the key (only ever hashed), like in _client, so
+    # users with different API keys never share cached replies
+    raw = orjson.dumps((str(client.base_url), client.api_key, kwargs), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+def stream_completion(client, source: str, round_no: int = 0, **kwargs) -> Choice:
+    """Streamed ``chat.completions.create`` returning an ordinary ``Choice``.
+
+    Text deltas are forwarded to the browser as ``token`` events tagged with
+    *source* while the model is still generating; tool-call fragments are
+    buffered per index until the stream ends. The returned Choice has the
+    same shape as a non-streamed response, so callers stay unchanged.
+    """
+    key = _response_key(client, kwargs)
+    with _RESPONSE_CACHE_LOCK:
+        cached = _RESPONSE_CACHE.get(key)
+        if cached is not None:
+            _RESPONSE_CACHE.move_to_end(key)
+    if cached is not None:
+        if cached.message.content:
+            socketio.emit("token", {"source": source, "text": cached.message.content, "round": round_no})
+        return cached
+    choice = _stream_completion(client, source, round_no, **kwargs)
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = choice
+        if len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+            _RESPONSE_CACHE.popitem(last=False)
+    return choice
+
+def _stream_completion(client, source: str | None, round_no: int, *,
+                       cancel: threading.Event | None = None, **kwargs) -> Choice | None:
+    """Collect a streamed completion into a Choice.
+
+    With *source* None nothing is forwarded to the browser. Setting *cancel*
+    closes the stream at the next chunk, which aborts the HTTP request and
+    the generation with it; None is returned then.
+    """
+    from openai import Timeout
+    from openai.types.chat.chat_completion import Choice
+    parts: list[str] = []
+    calls: dict[int, dict] = {}
+    finish_reason = "stop"
+    timeout = Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    with client.chat.completions.create(stream=True, timeout=timeout, **kwargs) as stream:
+        for chunk in stream:
+            if cancel is not None and cancel.is_set():
+                return None
+            if not chunk.choices:
+                continue
+            ch = chunk.choices[0]
+            delta = ch.delta
+            if delta.content:
+                parts.append(delta.content)
+                if source is not None:
+                    socketio.emit("token", {"source": source, "text": delta.content, "round": round_no})
+                    socketio.sleep(0)
+            for d in delta.tool_calls or ():
+                call = calls.setdefault(d.index, {"id": "", "type": "function",
+                                                  "function": {"name": "", "arguments": ""}})
+                if d.id:
+                    call["id"] = d.id
+                if d.function:
+                    call["function"]["name"] += d.function.name or ""
+                    call["function"]["arguments"] += d.function.arguments or ""
+            if ch.finish_reason:
+                finish_reason = ch.finish_reason
+    return Choice.model_validate({
+        "index": 0,
+        "finish_reason": finish_reason,
+        "message": {
+            "role": "assistant",
+            "content": "".join(parts),
+            "tool_calls": [calls[i] for i in sorted(calls)] or None,
+        },
+    })
+
+# Router decisions by the same kind of key; a repeated prompt over the same
+# recent history gets its answer/hand_off without another model call.
+_ROUTE_CACHE: collections.OrderedDict[bytes, str] = collections.OrderedDict()
+
+def route(client, model: str, messages: list[dict]) -> str:
+    """Ask the router model for 'answer' or 'hand_off' (memoized)."""
+    kwargs = {"model": model, "messages": messages,
+              "tools": ROUTER_TOOLS, "tool_choice": ROUTER_TOOL_CHOICE}
+    key = _response_key(client, kwargs)
+    with _RESPONSE_CACHE_LOCK:
+        decision = _ROUTE_CACHE.get(key)
+        if decision is not None:
+            _ROUTE_CACHE.move_to_end(key)
+            return decision
+    resp = client.chat.completions.create(**kwargs)
+    log.debug("router response: %s", resp)
+    call = resp.choices[0].message.tool_calls[0]
+    try:
+        decision = msgspec.json.decode(call.function.arguments or "{}", type=Decision).action
+    except msgspec.DecodeError:
+        return "hand_off"  # not cached: a malformed reply is worth asking again
+    with _RESPONSE_CACHE_LOCK:
+        _ROUTE_CACHE[key] = decision
+        if len(_ROUTE_CACHE) > RESPONSE_CACHE_SIZE:
+            _ROUTE_CACHE.popitem(last=False)
+    return decision
+
+# Agents re-send their whole transcript on every tool round. Once the tool
+# output in it passes the budget, results the model has already seen and
+# that are larger than the cap are replaced by a short stub.
+AGENT_TOOL_BUDGET = 32_768  # chars of tool output kept verbatim per agent
+AGENT_TOOL_RESULT_MAX = 4096
+
+def compact_tool_results(msgs: list[dict]) -> None:
+    """Stub out large, already-consumed tool results in *msgs* (in place)."""
+    tool_msgs = [m for m in msgs if m.get("role") == "tool"]
+    if sum(len(m["content"]) for m in tool_msgs) <= AGENT_TOOL_BUDGET:
+        return
+    for m in tool_msgs:
+        size = len(m["content"])
+        if size > AGENT_TOOL_RESULT_MAX:
+            m["content"] = (f"<tool result {m['tool_call_id']} truncated: {size} chars, "
+                            "already seen; call the tool again if you need it>")
+
 # map tool names to callables
 TOOL_FUNCS = {
     "write_file": write_file,
@@ -209,14 +729,130 @@ TOOL_FUNCS = {
     "change_file": change_file,
 }
 
+# Tools run on their own pool so a hung call (a FIFO passed to read_file, a
+# wedged git apply) costs the caller TOOL_TIMEOUT, not the whole agent.
+# One thread per agent thread, so a tool call doesn't sit queued behind other
+# agents' 30 s commands.
+TOOL_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=AGENT_WORKERS,
+                                                  thread_name_prefix="tool")
+TOOL_TIMEOUT = 35  # a bit above run_cmd's own 30 s subprocess timeout
+
+# Upper bounds on model round-trips, so a model that never stops calling
+# tools can't hold a request (and a pool thread) forever.
+MAX_TOOL_ROUNDS = 16  # per coder / agent conversation
+MAX_ORC_ROUNDS = 16   # orchestrator responses per request
+ROUNDS_EXCEEDED = "Stopped after %d model rounds without a final answer."
+
+def _submit_tool(fn, *args, **kwargs):
+    """Queue *fn* on TOOL_POOL; the event is set once it starts (or is cancelled)."""
+    started = threading.Event()
+    def call():
+        started.set()
+        return fn(*args, **kwargs)
+    fut = TOOL_POOL.submit(call)
+    fut.add_done_callback(lambda _: started.set())
+    return fut, started
+
+def _await_tool(name: str, fut, started: threading.Event):
+    """Result of a _submit_tool future; TOOL_TIMEOUT counts from when it started.
+
+    A call still queued after TOOL_TIMEOUT is cancelled, so the model is never
+    told "timed out" about a write that then lands anyway.
+    """
+    if not started.wait(TOOL_TIMEOUT) and fut.cancel():
+        return f"Tool error: {name} not run, no tool worker free for {TOOL_TIMEOUT}s."
+    try:
+        return fut.result(timeout=TOOL_TIMEOUT)
+    except concurrent.futures.CancelledError:
+        return f"Tool error: {name} not run."
+    except concurrent.futures.TimeoutError:
+        return f"Tool error: {name} timed out after {TOOL_TIMEOUT}s."
+
+def run_tool(name: str, args: dict) -> str:
+    """Execute tool *name* with *args* and return its textual result."""
+    return _await_tool(name, *_submit_tool(TOOL_FUNCS[name], **args))
+
+def _independent(calls: list[tuple[str, dict]]) -> bool:
+    """True if *calls* are file tools on pairwise distinct files.
+
+    Shell commands can touch anything, a patch's headers (not its filename
+    argument) pick the file it edits, and two calls on one file depend on
+    their order, so any of these forces the batch back to sequential
+    execution. Files are compared by resolved path, so "a.txt" and
+    "./a.txt" count as the same file.
+    """
+    if any(name == "change_file" for name, _ in calls):
+        return False
+    files = [args.get("filename") for _, args in calls]
+    if not all(isinstance(f, str) for f in files):
+        return False
+    keys = {os.path.realpath(tool_path(f)) for f in files}
+    return len(keys) == len(files)
+
+def run_tools(calls: list[tuple[str, dict]]) -> list[str]:
+    """Run one assistant turn's tool calls, concurrently when independent.
+
+    Results come back in call order, as the tool messages must.
+    """
+    if len(calls) > 1 and all(name == "change_file" for name, _ in calls):
+        # one git process for the whole turn's patches
+        batched = _await_tool("change_file",
+                              *_submit_tool(change_files, [args for _, args in calls]))
+        if isinstance(batched, str):  # timed out or never ran
+            return [batched] * len(calls)
+        if batched is not None:
+            return batched
+    if len(calls) < 2 or not _independent(calls):
+        return [run_tool(name, args) for name, args in calls]
+    pending = [_submit_tool(TOOL_FUNCS[name], **args) for name, args in calls]
+    return [_await_tool(name, *p) for p, (name, _) in zip(pending, calls)]
+
+def record_tool_run(call, args: dict, res: str, runs: list[dict], msgs: list[dict]) -> None:
+    """Log a finished tool call in *runs* and answer it in transcript *msgs*.
+
+    Shell commands are labelled by their command line, other tools by name.
+    """
+    name = call.function.name
+    label = args.get("command") if name == "write_command" else name
+    runs.append({"cmd": label, "result": res})
+    msgs.append({"role": "tool", "tool_call_id": call.id, "name": label, "content": res})
+
 # ---------- routes ---------- #
+def json_response(obj) -> Response:
+    """orjson-encoded JSON response (bypasses Flask's stdlib encoder)."""
+    return Response(orjson.dumps(obj), mimetype="application/json")
+
 @app.route("/")
 def index(): return render_template("index.html")
 
+HISTORY_CHUNK = 1 << 20  # bytes per slice streamed by /api/history
+
 @app.route("/api/history")
 def history():
-    """Return full conversation history."""
-    return jsonify(HISTORY)
+    """Return full conversation history, streamed from the JSONL log."""
+    HISTORY_Q.join()  # let queued records reach the file first
+    # the log only ever grows (or is truncated at startup), so its stat
+    # signature identifies the content; unchanged -> 304, no body at all
+    st = os.stat(HISTORY_FILE)
+    etag = f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    def gen():
+        # The log is one JSON object per line, so the array body is the mapped
+        # file with newlines turned into commas -- sent in slices, no parsing.
+        yield b"["
+        with open(HISTORY_FILE, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    end = mm.rfind(b"\n")  # skip a record still being appended
+                    for off in range(0, max(end, 0), HISTORY_CHUNK):
+                        yield mm[off:min(off + HISTORY_CHUNK, end)].replace(b"\n", b",")
+        yield b"]"
+    resp = Response(gen(), mimetype="application/json")
+    resp.set_etag(etag)
+    return resp
 
 @app.route("/api/chat", methods=["POST"])
 def chat():
@@ -226,6 +862,8 @@ def chat():
     orc_model  = data["orchestrator_model"]
     coder_model= data["coder_model"]
     workers    = int(data.get("workers", 2))
+    if workers < 1:
+        return {"error": "workers must be at least 1"}, 400
     orc_enabled = data.get("orc_enabled", True)
     api_token   = data.get("api_token")
     user_msg   = data["prompt"]
@@ -294,69 +932,65 @@ def chat():
     #     #     json.dump(HISTORY, f, ensure_ascii=False, indent=2)
     #     flush_history_to_disk()
     #     return jsonify({"plans": [], "coder": {"reply": decision, "tool_runs": coder_runs}, "orchestrator": None, "agents": []})
+    # ----- ask orchestrator for a plan -----
+    planner_sys = planner_sys_for(workers)
+    orc_messages = history_window({"role": "system", "content": planner_sys})
+    # Fire the first planner call alongside the router: if the router hands
+    # off, its reply is already in flight; if it answers, planner_cancel
+    # closes the stream, aborting the request instead of paying for the plan.
+    planner_fut = None
+    planner_cancel = threading.Event()
+    if SPECULATIVE_PLANNING and orc_enabled:
+        planner_fut = AGENT_POOL.submit(
+            _stream_completion, orc_client, None, 0,
+            cancel=planner_cancel,
+            model=orc_model,
+            messages=list(orc_messages),
+            tools=ORCH_TOOLS,
+            tool_choice="auto",
+        )
+
     # ---------------- Router (decision-only) ---------------- #
-    router_sys = (
-        "You are a routing assistant. Decide **only** whether the last user "
-        "message should be handled directly by the lightweight coder model "
-        "(`answer`) or forwarded to the orchestrator (`hand_off`). "
-        "Return the decision by calling the `route` function and nothing else."
-    )
-
-    router_messages = [{"role": "system", "content": router_sys}] + HISTORY[-6:]
-    router_resp = coder_client.chat.completions.create(
-        model=coder_model,
-        messages=router_messages,
-        tools=[DECISION_TOOL],
-        tool_choice={"type": "function", "function": {"name": "route"}},
-    )
-    print("Router response:", router_resp)
-    router_call = router_resp.choices[0].message.tool_calls[0]
-    decision_args = json.loads(router_call.function.arguments or "{}")
-    decision = decision_args.get("action", "hand_off")
+    try:
+        decision = route(coder_client, coder_model,
+                         history_window({"role": "system", "content": ROUTER_SYS}, ROUTER_TAIL))
+    except BaseException:
+        planner_cancel.set()  # a failed request mustn't leave the plan generating
+        raise
 
 
     # If the lightweight coder should answer immediately or the orchestrator is disabled
     if decision == "answer" or not orc_enabled:
+        planner_cancel.set()
         target_client = coder_client if decision == "answer" else orc_client
         target_model = coder_model if decision == "answer" else orc_model
-        coder_messages = (
-            [{"role": "system", "content": "You are a helpful coding assistant."}]
-            + HISTORY
-        )
+        coder_messages = history_window(CODER_SYS)
         coder_tool_runs = []
-        while True:
-            c_resp = target_client.chat.completions.create(
+        for _ in range(MAX_TOOL_ROUNDS):
+            c_choice = stream_completion(
+                target_client,
+                "coder" if decision == "answer" else "orchestrator",
                 model=target_model,
                 messages=coder_messages,
                 tools=TOOLS,
                 tool_choice="auto",
             )
-            c_choice = c_resp.choices[0]
             if c_choice.finish_reason == "tool_calls":
-                for tc in c_choice.message.tool_calls:
-                    t_args = json.loads(tc.function.arguments or "{}")
-                    log_tool_call(tc.function.name, t_args)
-                    res = TOOL_FUNCS[tc.function.name](**t_args)
-                    label = (
-                        t_args.get("command")
-                        if tc.function.name == "write_command"
-                        else tc.function.name
-                    )
-                    coder_tool_runs.append({"cmd": label, "result": res})
-                    coder_messages.extend(
-                        [
-                            {"role": "assistant", "tool_calls": [tc.model_dump(exclude_none=True)]},
-                            {"role": "tool", "tool_call_id": tc.id, "name": label, "content": res},
-                        ]
-                    )
+                parsed = [(tc, _loads(tc.function.arguments)) for tc in c_choice.message.tool_calls]
+                log_tool_calls((tc.function.name, t_args) for tc, t_args in parsed)
+                results = run_tools([(tc.function.name, t_args) for tc, t_args in parsed])
+                coder_messages.append({"role": "assistant", "tool_calls": [dump_tool_call(tc) for tc, _ in parsed]})
+                for (tc, t_args), res in zip(parsed, results):
+                    record_tool_run(tc, t_args, res, coder_tool_runs, coder_messages)
                 continue
             final_answer = c_choice.message.content.strip()
             break
+        else:
+            final_answer = ROUNDS_EXCEEDED % MAX_TOOL_ROUNDS
 
         add_history("assistant", final_answer)
-        flush_history_to_disk()
         if decision == "answer":
-            return jsonify(
+            return json_response(
                 {
                     "plans": [],
                     "coder": {"reply": final_answer, "tool_runs": coder_tool_runs},
@@ -365,7 +999,7 @@ def chat():
                 }
             )
         else:
-            return jsonify(
+            return json_response(
                 {
                     "plans": [],
                     "coder": None,
@@ -373,58 +1007,6 @@ def chat():
                     "agents": [],
                 }
             )
-    # ----- ask orchestrator for a plan -----
-    planner_sys = (
-        # "You are an orchestrator. Coder agents are independent and share no "
-        # "memory. Each agent only sees its own task list. You have up to %d "
-        # "workers available and must never exceed this number. "
-        # "When assigning "
-        # "tasks do not rely on one agent continuing work of another unless you "
-        # "explicitly provide the previous results. Respond ONLY with JSON like: "
-        # "{\"agents\":N,\"tasks\":[{\"agent\":1,\"desc\":\"task\"}]}"
-        " You are a code super agent and have the ability to orchestrate multiple smaller agents. "
-        " Your overall job is to guide the process and assign super specific tasks to smaller agents. "
-        " You can do this by assigning tasks to individual agents or you can execute commands on your own (the smaller agents can also execute the same commands like writing, reading and chaning files). "
-        " Before creating smaller agents, create a detailed plan for everything that needs to be done. "
-        " Right now you can have up to %d workers for 1 iteration. "
-        " When you spawn a new agent it has no memory of previous tasks so you should give it a detailed prompt and list what it needs to do. "
-        " Your agents work in parallel and can execute tasks independently but won't be able to work on the same file. "
-        " You also have the ability to execute more iterations after one is compelte - if a process requires more steps than your available workers or needs something to be done in sequence like writing a file then reading it, you can do that by creating more agents after you got feedback from the previous ones.\n\n "
-        "When assigning tasks do not rely on one agent continuing work of another unless you "
-        "explicitly provide the previous results. Respond ONLY with JSON like: "
-        "{\"agents\":N,\"tasks\":[{\"agent\":1,\"desc\":\"task\"}]}"
-        " When one a iteration is over and you have the results from all agents and think that the process is complete, report to the user with summary of what has been done. "
-        " This is the history of the conversation so far: \n"
-    ) % workers
-    plan_schema = {
-        "type": "object",
-        "properties": {
-            "agents": {"type": "integer"},
-            "tasks": {
-                "type": "array",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "agent": {"type": "integer"},
-                        "desc": {"type": "string"},
-                    },
-                    "required": ["agent", "desc"],
-                },
-            },
-        },
-        "required": ["agents", "tasks"],
-    }
-
-
-    plan_tool = {
-        "type": "function",
-        "function": {
-            "name": "make_plan",
-            "description": "Return a plan for the requested tasks.",
-            "parameters": plan_schema,
-        },
-    }
-    orc_messages = [{"role": "system", "content": planner_sys}] + HISTORY
     orc_tool_runs: list[dict] = []
     final_reply = ""
     all_plans: list[str] = []
@@ -432,115 +1014,107 @@ def chat():
     round_no = 0
 
     def run_agent(aid: int, tasks: list[str]):
-        msgs = [{"role": "system", "content": "You are coder agent %d. Complete ONLY the following tasks in order:\n%s" % (aid, "\n".join(f"- {t}" for t in tasks))}]
+        task_list = "\n".join(f"- {t}" for t in tasks)
+        msgs = [{"role": "system", "content": AGENT_SYS_TEMPLATE % (aid, task_list)}]
+        prefix_len = len(msgs)  # the agent's own prompt; not worth keeping past the run
         t_runs = []
-        while True:
-            r = coder_client.chat.completions.create(model=coder_model, messages=msgs, tools=TOOLS, tool_choice="auto")
-            c = r.choices[0]
+        # agents run in parallel; buffer their traces and flush once at the end
+        # instead of contending for the history lock on every tool call
+        pending: list[tuple[str, str]] = []
+        for _ in range(MAX_TOOL_ROUNDS):
+            c = stream_completion(coder_client, f"agent {aid}", round_no,
+                                  model=coder_model, messages=msgs, tools=TOOLS, tool_choice="auto")
+            compact_tool_results(msgs)
             if c.finish_reason == "tool_calls":
-                for a in c.message.tool_calls:
-                    a_args = json.loads(a.function.arguments or "{}")
-                    log_tool_call(a.function.name, a_args)
-                    res = TOOL_FUNCS[a.function.name](**a_args)
-                    label = a_args.get("command") if a.function.name == "write_command" else a.function.name
-                    t_runs.append({"cmd": label, "result": res})
-                    msgs.append({"role": "assistant", "tool_calls": [a.model_dump(exclude_none=True)]})
-                    msgs.append({"role": "tool", "tool_call_id": a.id, "name": label, "content": res})
+                parsed = [(a, _loads(a.function.arguments)) for a in c.message.tool_calls]
+                pending.extend(("assistant", tool_call_trace(a.function.name, a_args)) for a, a_args in parsed)
+                results = run_tools([(a.function.name, a_args) for a, a_args in parsed])
+                msgs.append({"role": "assistant", "tool_calls": [dump_tool_call(a) for a, _ in parsed]})
+                for (a, a_args), res in zip(parsed, results):
+                    record_tool_run(a, a_args, res, t_runs, msgs)
                 continue
             msgs.append({"role": "assistant", "content": c.message.content})
-            return {"id": aid, "reply": c.message.content, "tool_runs": t_runs, "messages": msgs, "round": round_no}
+            add_history_many(pending)
+            return {"id": aid, "reply": c.message.content, "tool_runs": t_runs, "messages": msgs[prefix_len:], "round": round_no}
+        add_history_many(pending)
+        reply = ROUNDS_EXCEEDED % MAX_TOOL_ROUNDS
+        return {"id": aid, "reply": reply, "tool_runs": t_runs, "messages": msgs[prefix_len:], "round": round_no}
 
+    def dispatch(plan: Plan) -> str:
+        """Fan the plan's tasks out to coder agents and return their summary."""
+        num_agents = min(plan.agents, workers)
+        agent_tasks: dict[int, list[str]] = collections.defaultdict(list)
+        for t in plan.tasks:
+            agent_tasks[t.agent if 1 <= t.agent <= num_agents else 1].append(t.desc)
+        # submit every agent before waiting on any, or they'd run one by one
+        futs = [AGENT_POOL.submit(run_agent, aid, tasks) for aid, tasks in agent_tasks.items()]
+        # surface agents as soon as they finish rather than after the slowest;
+        # those that finish together go out in one 'agent_results' frame
+        results = []
+        pending = set(futs)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            batch = [f.result() for f in done]
+            results.extend(batch)
+            all_agents.extend(batch)
+            # HISTORY.extend(r["messages"])
+            socketio.emit('agent_results', {'round': round_no, 'results': [{
+                'id': r['id'], 'reply': r['reply'],
+                'tool_runs': r['tool_runs'], 'round': r['round']
+            } for r in batch]})
+        results.sort(key=lambda r: r["id"])
+        add_history_many([("assistant", r["reply"]) for r in results])
+        return "\n".join(f"Agent {r['id']} result: {r['reply']}" for r in results)
 
-    while True:
-        print("\n\n\n")
-        print(f"Round {round_no} messages: {orc_messages}")
-        resp = orc_client.chat.completions.create(
-            model=orc_model,
-            messages=orc_messages,
-            tools=TOOLS + [plan_tool],
-            tool_choice="auto",
-        )
-        print("\n\n\n")
-        print(f"Round {round_no} response: {resp}")
-        print("\n\n\n")
+
+    while round_no < MAX_ORC_ROUNDS:
+        log.debug("round=%d msgs=%d", round_no, len(orc_messages))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("round=%d messages: %s", round_no, _dumps(orc_messages))
+        if planner_fut is not None:
+            choice, planner_fut = planner_fut.result(), None
+        else:
+            choice = orc_client.chat.completions.create(
+                model=orc_model,
+                messages=orc_messages,
+                tools=ORCH_TOOLS,
+                tool_choice="auto",
+            ).choices[0]
+        log.debug("round=%d response: %s", round_no, choice)
         plan_text = "{}"
-        plan = {"agents": 0, "tasks": []}
-        choice = resp.choices[0]
         round_no += 1
 
         if choice.finish_reason == "tool_calls":
-            orc_messages.append({"role": "assistant", "tool_calls": [c.model_dump(exclude_none=True) for c in choice.message.tool_calls]})
-            for call in choice.message.tool_calls:
-                args = json.loads(call.function.arguments or "{}")
-                log_tool_call(call.function.name, args)
-                if call.function.name == "make_plan":
-                    plan_text = call.function.arguments or "{}"
+            orc_messages.append({"role": "assistant", "tool_calls": [dump_tool_call(c) for c in choice.message.tool_calls]})
+            parsed = [(call, _loads(call.function.arguments)) for call in choice.message.tool_calls]
+            log_tool_calls((call.function.name, args) for call, args in parsed)
+            # consecutive ordinary tool calls run as one batch; plans stay
+            # in sequence with them since agents may depend on earlier edits
+            for is_plan, group in itertools.groupby(parsed, key=lambda p: p[0].function.name == "make_plan"):
+                group = list(group)
+                if not is_plan:
+                    results = run_tools([(call.function.name, args) for call, args in group])
+                    for (call, args), res in zip(group, results):
+                        record_tool_run(call, args, res, orc_tool_runs, orc_messages)
+                    continue
+                for call, args in group:
+                    # args already holds the parsed plan; keep the raw text for the transcript
+                    plan, plan_text = parse_plan(args), call.function.arguments or "{}"
                     orc_messages.append({"role": "tool", "tool_call_id": call.id, "name": "make_plan", "content": plan_text})
-                    try:
-                        plan = json.loads(plan_text)
-                    except Exception:
-                        plan = {"agents": 0, "tasks": []}
                     all_plans.append(plan_text)
-                    socketio.emit('plan', {'plan': plan_text, 'round': round_no})
-                    if plan.get("tasks") and plan.get("agents", 0) > 0:
-                        num_agents = min(int(plan.get("agents", 1)), workers)
-                        agent_tasks = {i: [] for i in range(1, num_agents + 1)}
-                        for t in plan.get("tasks", []):
-                            aid = int(t.get("agent", 1))
-                            if aid not in agent_tasks:
-                                aid = 1
-                            agent_tasks[aid].append(t.get("desc", ""))
-                        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
-                            futs = [ex.submit(run_agent, aid, tasks) for aid, tasks in agent_tasks.items() if tasks]
-                            results = [f.result() for f in futs]
-                        for r in results:
-                            all_agents.append(r)
-                            # HISTORY.extend(r["messages"])
-                            add_history("assistant", r["reply"])
-                            socketio.emit('agent_result', {
-                                'id': r['id'], 'reply': r['reply'],
-                                'tool_runs': r['tool_runs'], 'round': r['round']
-                            })
-                        summary = "\n".join(f"Agent {r['id']} result: {r['reply']}" for r in results)
-                        orc_messages.append({"role": "user", "content": summary})
-                    continue
-                else:
-                    res = TOOL_FUNCS[call.function.name](**args)
-                    label = args.get("command") if call.function.name == "write_command" else call.function.name
-                    orc_tool_runs.append({"cmd": label, "result": res})
-                    orc_messages.append({"role": "tool", "tool_call_id": call.id, "name": label, "content": res})
+                    emit_plan(plan, plan_text, round_no)
+                    if plan is not None and plan.tasks and plan.agents > 0:
+                        orc_messages.append({"role": "user", "content": dispatch(plan)})
             continue
 
         text = choice.message.content or ""
-        try:
-            plan = json.loads(text)
-        except Exception:
-            plan = None
+        plan = parse_plan(text)
 
-        if isinstance(plan, dict) and "tasks" in plan and "agents" in plan:
+        if plan is not None:
             all_plans.append(text)
-            socketio.emit('plan', {'plan': text, 'round': round_no})
-            if plan.get("tasks") and plan.get("agents", 0) > 0:
-                num_agents = min(int(plan.get("agents", 1)), workers)
-                agent_tasks = {i: [] for i in range(1, num_agents + 1)}
-                for t in plan.get("tasks", []):
-                    aid = int(t.get("agent", 1))
-                    if aid not in agent_tasks:
-                        aid = 1
-                    agent_tasks[aid].append(t.get("desc", ""))
-                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
-                    futs = [ex.submit(run_agent, aid, tasks) for aid, tasks in agent_tasks.items() if tasks]
-                    results = [f.result() for f in futs]
-                for r in results:
-                    all_agents.append(r)
-                    # HISTORY.extend(r["messages"])
-                    add_history("assistant", r["reply"])
-                    socketio.emit('agent_result', {
-                        'id': r['id'], 'reply': r['reply'],
-                        'tool_runs': r['tool_runs'], 'round': r['round']
-                    })
-                summary = "\n".join(f"Agent {r['id']} result: {r['reply']}" for r in results)
-                orc_messages.append({"role": "user", "content": summary})
+            emit_plan(plan, text, round_no)
+            if plan.tasks and plan.agents > 0:
+                orc_messages.append({"role": "user", "content": dispatch(plan)})
                 continue
             else:
                 break
@@ -548,17 +1122,17 @@ def chat():
         final_reply = text
         orc_messages.append({"role": "assistant", "content": text})
         break
+    else:
+        final_reply = ROUNDS_EXCEEDED % MAX_ORC_ROUNDS
 
     # HISTORY.append({"role": "assistant", "content": "\n".join(all_plans)})
-    add_history("assistant", "\n".join(all_plans))
+    if all_plans:
+        add_history("assistant", "\n".join(all_plans))
     if final_reply:
         # HISTORY.append({"role": "assistant", "content": final_reply})
         add_history("assistant", final_reply)
-    # with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-    #     json.dump(HISTORY, f, ensure_ascii=False, indent=2)
-    flush_history_to_disk()
 
-    return jsonify({
+    return json_response({
         "plans": all_plans,
         "orchestrator": {"reply": final_reply, "tool_runs": orc_tool_runs},
         "agents": [{"id": a["id"], "reply": a["reply"], "tool_runs": a["tool_runs"], "round": a["round"]} for a in all_agents]
@@ -568,10 +1142,8 @@ def chat():
 def terminal():
     cmd   = request.json["command"]
     out   = run_cmd(cmd)
-    log_tool_call("shell", {"command": cmd})
-    log_tool_call("shell_result", {"result": out})
-    flush_history_to_disk()
-    return jsonify({"cmd": cmd, "result": out})
+    log_tool_calls([("shell", {"command": cmd}), ("shell_result", {"result": out})])
+    return json_response({"cmd": cmd, "result": out})
 
 # ---------- main ---------- #
 if __name__ == "__main__":
@@ -48,7 +48,27 @@ socket.on('plan', d => {
   }
 });
 
-socket.on('agent_result', a => {
+/* ---------- STREAMING ---------- */
+const streams = {};   // source -> live bubble while the model is generating
+socket.on('token', d => {
+  let b = streams[d.source];
+  if(!b){
+    b = streams[d.source] = bubble(`[${d.source}] `, 'ai', chatPane);
+    b.classList.add('streaming');
+  }
+  b.textContent += d.text;
+  chatPane.scrollTop = chatPane.scrollHeight;
+});
+function endStream(source){
+  // the final reply is rendered as a normal bubble; drop the live one
+  const sources = source ? [source] : Object.keys(streams);
+  sources.forEach(s => {
+    if(streams[s]){ streams[s].remove(); delete streams[s]; }
+  });
+}
+
+function showAgent(a){
+  endStream(`agent ${a.id}`);
   const key = `${a.round}-${a.id}`;
   if(shownAgents.has(key)) return;
   shownAgents.add(key);
@@ -56,7 +76,9 @@ socket.on('agent_result', a => {
     bubble(`[A${a.id}] $ ${t.cmd}\n${t.result}`, 'code', termPane);
   });
   bubble(`[Agent ${a.id}] ${a.reply}`, 'ai', chatPane);
-});
+}
+
+socket.on('agent_results', b => b.results.forEach(showAgent));
 
 async function loadHistory(){
   const r = await fetch("/api/history");
@@ -94,7 +116,8 @@ function bubble(text, cls, pane, html=false){
 
 function showPlan(planStr, round){
   try{
-    const plan = JSON.parse(planStr);
+    // live 'plan' events carry an object; /api/chat's plans list has strings
+    const plan = typeof planStr === 'string' ? JSON.parse(planStr) : planStr;
     let html = `<strong>Plan ${round}:</strong><br>Agents: ${plan.agents}<ul>`;
 
     plan.tasks.forEach(t=>{ html += `<li>[Agent ${t.agent}] ${t.desc}</li>`; });
@@ -120,6 +143,8 @@ async function sendChat(){
     workers: parseInt(document.getElementById("workers").value,10),
     orc_enabled: orcEnabled
   });
+  endStream();
+  if(data.error){ bubble(data.error,"ai",chatPane); return; }
 
   (data.plans||[]).forEach((p,i)=>{
     if(!shownPlans.has(i+1)){